@@ -36,13 +36,14 @@ REPORT_COLUMNS = [
 ]
 
 # Data Validation — top‑10 cryptos only
-REQUIRED_KEYS = [
+REQUIRED_KEYS = (
     "BTCZAR", "ETHZAR", "BNBZAR", "XRPZAR", "ADAZAR",
     "SOLZAR", "DOGEZAR", "DOTZAR", "TRXZAR", "LTCZAR"
-]
+)
+REQUIRED_KEYS_SET = frozenset(REQUIRED_KEYS)
 
 def validate_data(data):
-    missing = [key for key in REQUIRED_KEYS if key not in data]
+    missing = REQUIRED_KEYS_SET - data.keys()
     if missing:
-        raise ValueError(f"Missing data keys: {', '.join(missing)}")
+        raise ValueError(f"Missing data keys: {', '.join(sorted(missing))}")
     return True
@@ -1,199 +1,338 @@
-from pycoingecko import CoinGeckoAPI
+import requests
+from requests.adapters import HTTPAdapter
+from dataclasses import asdict, dataclass
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
+import bisect
+import json
+import random
 import time
 import concurrent.futures
-import signal
-from functools import partial
+import threading
+from functools import lru_cache, partial
 
 # Configuration
+API_BASE = "https://api.coingecko.com/api/v3"
 REQUEST_TIMEOUT = 15  # seconds per API call
-TOTAL_TIMEOUT = 60  # seconds for entire operation
-MAX_RETRIES = 3
+TOTAL_TIMEOUT = 60  # seconds for the whole fetch, markets call included
+MAX_RETRIES = 3  # attempts per request, including the first
 RETRY_DELAY = 1
-MAX_WORKERS = 4  # concurrent API calls
-
-class TimeoutError(Exception):
-    pass
-
-def timeout_handler(signum, frame):
-    raise TimeoutError("Operation timed out")
-
-def with_retry(max_retries=MAX_RETRIES, delay=RETRY_DELAY):
-    """Decorator for retry logic with exponential backoff"""
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            last_error = None
-            for attempt in range(max_retries):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    last_error = e
-                    if attempt < max_retries - 1:
-                        time.sleep(delay * (attempt + 1))
-            raise last_error
-        return wrapper
-    return decorator
+MAX_RETRY_AFTER = 20  # cap on a server-requested Retry-After wait, in seconds
+MAX_WORKERS = 5  # concurrent API calls
+MIN_CALL_INTERVAL = 1.2  # seconds between CoinGecko calls (free-tier rate limit)
+CACHE_FILE = ".cg_cache.json"
+YTD_WINDOW = timedelta(days=2)  # range searched for the first price of the year
+YTD_CACHE_TTL = 3600  # while the Jan 1 window is still open; closed windows last the year
+# How long a coin's last good row may stand in for a failed fetch. Deliberately
+# short: with the weekly schedule it only covers reruns/manual dispatches within a
+# day of a good run, since week-old prices would render as if current
+STALE_TTL = 86_400
+
+# (CoinGecko id, symbol, report key) for the top-10 coins
+_CRYPTOS: Tuple[Tuple[str, str, str], ...] = (
+    ("bitcoin", "BTC", "BTCZAR"),
+    ("ethereum", "ETH", "ETHZAR"),
+    ("binancecoin", "BNB", "BNBZAR"),
+    ("ripple", "XRP", "XRPZAR"),
+    ("cardano", "ADA", "ADAZAR"),
+    ("solana", "SOL", "SOLZAR"),
+    ("dogecoin", "DOGE", "DOGEZAR"),
+    ("polkadot", "DOT", "DOTZAR"),
+    ("tron", "TRX", "TRXZAR"),
+    ("litecoin", "LTC", "LTCZAR"),
+)
+_COIN_IDS = ",".join(coin_id for coin_id, _, _ in _CRYPTOS)
+
+# Failures worth retrying (retry_call still gives up at once on a non-429 4xx);
+# anything else is a bug and should surface
+RETRY_EXCEPTIONS = (requests.exceptions.RequestException, ValueError)
+
+_rate_lock = threading.Lock()
+_cache_lock = threading.Lock()
+_last_call = 0.0
+
+@dataclass(frozen=True)
+class FetcherConfig:
+    """Tuning knobs for fetch_market_data; defaults match the module constants."""
+    concurrency: int = MAX_WORKERS
+    retries: int = MAX_RETRIES  # attempts per request, including the first (minimum 1)
+    timeout: float = REQUEST_TIMEOUT
+    total_timeout: float = TOTAL_TIMEOUT
+    cache_ttl: int = YTD_CACHE_TTL
+
+@dataclass(slots=True)
+class CoinRow:
+    """One coin's report line: ZAR price and percentage changes."""
+    today: float
+    change: float
+    monthly: float
+    ytd: float
+
+@lru_cache(maxsize=None)
+def get_session(config: FetcherConfig) -> requests.Session:
+    """Return the process-wide pooled keep-alive CoinGecko session for a config."""
+    session = requests.Session()
+    # No transport-level retries: the app-level retry owns backoff, so it can
+    # throttle every attempt and see the 429 response (and its Retry-After)
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=max(10, config.concurrency),
+        max_retries=0
+    )
+    session.mount("https://", adapter)
+    session.headers["Connection"] = "keep-alive"
+    return session
+
+def cg_get(session: requests.Session, path: str, params: Dict[str, Any], timeout: float) -> Any:
+    """GET a CoinGecko API path and decode the JSON body."""
+    response = session.get(f"{API_BASE}{path}", params=params, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+def throttle(deadline: Optional[float] = None):
+    """Space CoinGecko calls at least MIN_CALL_INTERVAL apart across threads.
+
+    Raises Timeout instead of letting a call start at or after `deadline`.
+    """
+    global _last_call
+    with _rate_lock:
+        wait = _last_call + MIN_CALL_INTERVAL - time.monotonic()
+        if deadline is not None and time.monotonic() + max(wait, 0) >= deadline:
+            raise requests.exceptions.Timeout("Overall deadline reached")
+        if wait > 0:
+            time.sleep(wait)
+        _last_call = time.monotonic()
+
+def retry_delay(error: Exception, attempt: int, delay: float = RETRY_DELAY) -> float:
+    """Honour Retry-After on a 429 (capped), else back off exponentially with jitter."""
+    response = getattr(error, "response", None)
+    if response is not None and response.status_code == 429:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), MAX_RETRY_AFTER)
+    return delay * 2 ** attempt + random.uniform(0, 0.5)
+
+def retry_call(func, *args, attempts: int = MAX_RETRIES, deadline: Optional[float] = None, **kwargs):
+    """Throttle and call func, retrying transient errors; `attempts` counts every try (minimum 1).
+
+    No attempt starts, and no back-off sleeps, past `deadline` (a time.monotonic() value).
+    """
+    attempts = max(1, attempts)
+    for attempt in range(attempts):
+        throttle(deadline)
+        try:
+            return func(*args, **kwargs)
+        except RETRY_EXCEPTIONS as e:
+            # A 4xx other than 429 (bad coin id, missing API key) won't fix itself
+            response = getattr(e, "response", None)
+            if response is not None and 400 <= response.status_code < 500 and response.status_code != 429:
+                raise
+            if attempt == attempts - 1:
+                raise
+            delay = retry_delay(e, attempt)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise
+            time.sleep(delay)
+
+def load_cache() -> Dict[str, Any]:
+    """Load cached prices and rows from disk, starting empty if unreadable."""
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache: Dict[str, Any]) -> None:
+    """Persist cached prices and rows, dropping expired entries."""
+    now = time.time()
+    with _cache_lock:
+        live = {k: v for k, v in cache.items() if v["expires"] is None or v["expires"] > now}
+    try:
+        with open(CACHE_FILE, "w") as f:
+            json.dump(live, f)
+    except OSError as e:
+        print(f"⚠️ Cache write error: {str(e)[:100]}")
+
+def cache_get(cache: Dict[str, Any], key: str) -> Any:
+    """Return a cached value if present and not expired."""
+    entry = cache.get(key)
+    if entry and (entry["expires"] is None or entry["expires"] > time.time()):
+        return entry["value"]
+    return None
+
+def cache_set(cache: Dict[str, Any], key: str, value: Any, ttl: Optional[int]) -> None:
+    """Store a value with an expiry (None keeps it forever); missing values are never cached."""
+    if value is None:
+        return
+    with _cache_lock:
+        cache[key] = {"value": value, "expires": None if ttl is None else time.time() + ttl}
 
 def calculate_percentage(old: Optional[float], new: Optional[float]) -> float:
     """Safely calculate percentage change with absolute denominator."""
-    try:
-        if None in (old, new) or old == 0:
-            return 0.0
-        return ((new - old) / abs(old)) * 100
-    except Exception:
+    if old is None or new is None or old == 0:
         return 0.0
+    return ((new - old) / abs(old)) * 100
 
-@with_retry()
-def get_coin_ytd_price(cg: CoinGeckoAPI, coin_id: str) -> Optional[float]:
-    """Fetch YTD price with wider window and validation."""
-    try:
-        year = datetime.now(timezone.utc).year
-        start = datetime(year, 1, 1, tzinfo=timezone.utc)
-        end = start + timedelta(days=2)  # 2-day window
-        history = cg.get_coin_market_chart_range_by_id(
-            coin_id, "zar",
-            int(start.timestamp()), int(end.timestamp()),
-            timeout=REQUEST_TIMEOUT
-        )
-        prices = history.get('prices', [])
-        return next((p[1] for p in prices 
-                   if datetime.fromtimestamp(p[0]/1000).date() >= start.date()), None)
-    except Exception as e:
-        print(f"⚠️ YTD error for {coin_id}: {str(e)[:100]}")
-        return None
+def get_coin_ytd_price(session: requests.Session, coin_id: str, *, year_start: datetime,
+                       timeout: float = REQUEST_TIMEOUT) -> Optional[float]:
+    """Fetch the first price on or after Jan 1 from a 2-day window."""
+    start_ts = year_start.timestamp()
+    end_ts = (year_start + YTD_WINDOW).timestamp()
+    history = cg_get(
+        session, f"/coins/{coin_id}/market_chart/range",
+        {"vs_currency": "zar", "from": int(start_ts), "to": int(end_ts)},
+        timeout
+    )
+    prices = history.get("prices", []) if history else []
+    i = bisect.bisect_left([p[0] for p in prices], start_ts * 1000)
+    return prices[i][1] if i < len(prices) else None
 
-@with_retry()
-def fetch_coin_historical(cg: CoinGeckoAPI, coin_id: str, days: int) -> Optional[float]:
-    """Fetch historical price with adaptive time windows."""
-    try:
-        target = datetime.now(timezone.utc) - timedelta(days=days)
-        window = timedelta(minutes=30) if days == 1 else timedelta(hours=12)
-        
-        history = cg.get_coin_market_chart_range_by_id(
-            coin_id, "zar",
-            int((target - window).timestamp()),
-            int((target + window).timestamp()),
-            timeout=REQUEST_TIMEOUT
-        )
-        
-        if not history:
-            return None
-            
-        prices = history.get("prices", [])
-        if not prices:
-            return None
-            
-        target_ts = target.timestamp() * 1000
-        closest = min(prices, key=lambda x: abs(x[0] - target_ts))
-        return closest[1]
-    except Exception as e:
-        print(f"⚠️ Historical error for {coin_id} at {days}d: {str(e)[:100]}")
-        return None
+def _build_entry(today: Optional[float], change: Optional[float], monthly: Optional[float],
+                 ytd_hist: Optional[float]) -> CoinRow:
+    """Assemble a coin's report row, zero-filled when the current price is invalid."""
+    if not isinstance(today, (int, float)):
+        return CoinRow(0.0, 0.0, 0.0, 0.0)
+    return CoinRow(
+        today=float(today),
+        change=float(change) if isinstance(change, (int, float)) else 0.0,
+        monthly=float(monthly) if isinstance(monthly, (int, float)) else 0.0,
+        ytd=calculate_percentage(ytd_hist, today) if ytd_hist else 0.0
+    )
 
-def fetch_coin_data(cg: CoinGeckoAPI, coin_id: str, symbol: str, prices: Dict) -> Dict:
-    """Process a single coin's data with timeout protection."""
-    try:
-        today = prices.get(coin_id, {}).get("zar")
-        if today is None:
-            raise ValueError("Missing current price")
-            
-        day_hist = fetch_coin_historical(cg, coin_id, 1)
-        month_hist = fetch_coin_historical(cg, coin_id, 30)
-        ytd_hist = get_coin_ytd_price(cg, coin_id)
-
-        return {
-            "symbol": symbol,
-            "data": {
-                "Today": float(today),
-                "Change": calculate_percentage(day_hist, today),
-                "Monthly": calculate_percentage(month_hist, today),
-                "YTD": calculate_percentage(ytd_hist, today) if ytd_hist else 0.0
-            },
-            "status": "success"
-        }
-    except Exception as e:
-        print(f"⚠️ Processing error for {symbol}: {str(e)[:100]}")
-        return {
-            "symbol": symbol,
-            "data": {
-                "Today": 0.0,
-                "Change": 0.0,
-                "Monthly": 0.0,
-                "YTD": 0.0
-            },
-            "status": f"error: {str(e)[:100]}"
-        }
+def _stale_or_empty(cache: Dict, symbol: str, reason: str) -> Dict:
+    """Fall back to the coin's last good row if recent enough, else a zero-filled row."""
+    last = cache_get(cache, f"last:{symbol}")
+    if last is not None:
+        return {"symbol": symbol, "data": CoinRow(**last), "status": "stale"}
+    return {
+        "symbol": symbol,
+        "data": _build_entry(None, None, None, None),
+        "status": f"error: {reason}"
+    }
 
-def fetch_market_data() -> Optional[Dict[str, Any]]:
-    """Main function with complete timeout protection."""
-    signal.signal(signal.SIGALRM, timeout_handler)
-    signal.alarm(TOTAL_TIMEOUT)
-    
-    try:
-        cg = CoinGeckoAPI()
-        crypto_ids = {
-            "bitcoin": "BTC",
-            "ethereum": "ETH",
-            "binancecoin": "BNB",
-            "ripple": "XRP",
-            "cardano": "ADA",
-            "solana": "SOL",
-            "dogecoin": "DOGE",
-            "polkadot": "DOT",
-            "tron": "TRX",
-            "litecoin": "LTC",
-        }
+def fetch_coin_data(session: requests.Session, coin_id: str, symbol: str, quote: Optional[Tuple], cache: Dict,
+                    *, year_start: datetime, config: FetcherConfig, deadline: Optional[float] = None) -> Dict:
+    """Process a single coin's data; only the YTD network call is guarded."""
+    today, change, monthly = quote or (None, None, None)
+    if not isinstance(today, (int, float)):
+        print(f"⚠️ Processing error for {symbol}: Missing current price")
+        return _stale_or_empty(cache, symbol, "Missing current price")
 
-        # Get current prices with retry
-        prices = None
-        for attempt in range(MAX_RETRIES):
-            try:
-                prices = cg.get_price(
-                    ids=','.join(crypto_ids.keys()),
-                    vs_currencies="zar",
-                    timeout=REQUEST_TIMEOUT
-                )
-                if prices:
-                    break
-            except Exception as e:
-                if attempt == MAX_RETRIES - 1:
-                    raise
-                time.sleep(RETRY_DELAY * (attempt + 1))
+    ytd_key = f"{coin_id}:{year_start.date().isoformat()}"
+    ytd_hist = cache_get(cache, ytd_key)
+    if ytd_hist is None:
+        try:
+            ytd_hist = retry_call(
+                get_coin_ytd_price, session, coin_id, attempts=config.retries, deadline=deadline,
+                year_start=year_start, timeout=config.timeout
+            )
+        except RETRY_EXCEPTIONS as e:
+            print(f"⚠️ YTD error for {coin_id}: {str(e)[:100]}")
+        # A fully closed window's price can never change, so keep it until the
+        # year rolls over; save_cache then prunes it with the other expired entries
+        now_ts = time.time()
+        if (year_start + YTD_WINDOW).timestamp() <= now_ts:
+            ttl = year_start.replace(year=year_start.year + 1).timestamp() - now_ts
+        else:
+            ttl = config.cache_ttl
+        cache_set(cache, ytd_key, ytd_hist, ttl)
+
+    row = _build_entry(today, change, monthly, ytd_hist)
+    cache_set(cache, f"last:{symbol}", asdict(row), STALE_TTL)
+    return {"symbol": symbol, "data": row, "status": "success"}
+
+def get_markets(session: requests.Session, timeout: float) -> list:
+    """Fetch the /coins/markets rows for all coins; an empty reply counts as a failure."""
+    markets = cg_get(
+        session, "/coins/markets",
+        {"vs_currency": "zar", "ids": _COIN_IDS, "price_change_percentage": "24h,30d"},
+        timeout
+    )
+    if not markets:
+        raise ValueError("Empty /coins/markets response")
+    return markets
+
+def fetch_quotes(session: requests.Session, config: FetcherConfig,
+                 deadline: Optional[float] = None) -> Dict[str, Tuple]:
+    """Fetch current prices and 24h/30d changes for all coins in one call."""
+    markets = retry_call(get_markets, session, config.timeout, attempts=config.retries, deadline=deadline)
+    # Flatten to (price, 24h %, 30d %) per coin id
+    return {
+        row["id"]: (
+            row.get("current_price"),
+            row.get("price_change_percentage_24h_in_currency"),
+            row.get("price_change_percentage_30d_in_currency")
+        )
+        for row in markets
+    }
+
+def fetch_market_data(config: Optional[FetcherConfig] = None) -> Optional[Dict[str, Any]]:
+    """Fetch every coin's report row within config.total_timeout.
 
-        if not prices:
-            raise ValueError("Failed to fetch prices after retries")
+    The deadline covers the markets call, retry back-off and the coin pool; no
+    request starts after it, and one already in flight may overrun it by at
+    most config.timeout.
+    """
+    config = config or FetcherConfig()
+    deadline = time.monotonic() + config.total_timeout
+    try:
+        session = get_session(config)
+        try:
+            quotes = fetch_quotes(session, config, deadline)
+        except RETRY_EXCEPTIONS as e:
+            # Carry on so each coin can fall back to its last good row
+            print(f"⚠️ Price fetch error: {str(e)[:100]}")
+            quotes = {}
 
+        now = datetime.now(timezone.utc)
+        year_start = datetime(now.year, 1, 1, tzinfo=timezone.utc)
+        cache = load_cache()
         result = {
-            "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M UTC"),
+            "timestamp": now.strftime("%Y-%m-%d %H:%M UTC"),
             "data_status": {}
         }
 
-        # Process coins in parallel with thread pool
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = [
-                executor.submit(
-                    partial(fetch_coin_data, cg, coin_id, symbol, prices)
+        # Process coins in parallel; coins still running at the deadline fall back
+        # to a stale row, or a zero-filled one, exactly like coins that failed
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.concurrency)
+        futures = {
+            executor.submit(
+                partial(
+                    fetch_coin_data, session, coin_id, symbol,
+                    quotes.get(coin_id), cache,
+                    year_start=year_start, config=config, deadline=deadline
                 )
-                for coin_id, symbol in crypto_ids.items()
-            ]
-            
-            for future in concurrent.futures.as_completed(futures, timeout=TOTAL_TIMEOUT):
+            ): (symbol, zar_key)
+            for coin_id, symbol, zar_key in _CRYPTOS
+        }
+        done, not_done = concurrent.futures.wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        for future in done:
+            symbol, zar_key = futures[future]
+            try:
                 coin_result = future.result()
-                result[f"{coin_result['symbol']}ZAR"] = coin_result["data"]
-                result["data_status"][coin_result["symbol"]] = coin_result["status"]
+            except Exception as e:
+                # Unexpected per-coin failure (e.g. a malformed payload): isolate it to this coin
+                print(f"⚠️ Processing error for {symbol}: {str(e)[:100]}")
+                coin_result = _stale_or_empty(cache, symbol, str(e)[:100])
+            result[zar_key] = coin_result["data"]
+            result["data_status"][symbol] = coin_result["status"]
+        for future in not_done:
+            symbol, zar_key = futures[future]
+            print(f"⏱️ {symbol} timed out after {config.total_timeout}s")
+            fallback = _stale_or_empty(cache, symbol, "timed out")
+            result[zar_key] = fallback["data"]
+            result["data_status"][symbol] = fallback["status"]
 
+        save_cache(cache)
+        if not any(s in ("success", "stale") for s in result["data_status"].values()):
+            raise ValueError("No current or recent prices for any coin")
         return result
 
-    except TimeoutError:
-        print(f"⏱️ Operation timed out after {TOTAL_TIMEOUT}s")
-        return None
     except Exception as e:
         print(f"❌ Critical error: {str(e)[:100]}")
         return None
-    finally:
-        signal.alarm(0)  # Disable alarm
 
 if __name__ == "__main__":
     print("🚀 Starting crypto data fetch...")
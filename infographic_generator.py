@@ -1,13 +1,25 @@
 from PIL import Image, ImageDraw, ImageFont
 from datetime import datetime
+import io
+from functools import lru_cache
+from itertools import accumulate
 from config import *
 
-def generate_infographic(data):
+# Column left edges and widths, derived once from the report layout
+COL_WIDTHS = tuple(width for _, width in REPORT_COLUMNS)
+COL_X = tuple(accumulate((25,) + COL_WIDTHS))
+
+@lru_cache(maxsize=None)
+def _font(path, size):
+    # All text is Latin/digits, so skip complex (HarfBuzz) shaping
+    return ImageFont.truetype(path, size, layout_engine=ImageFont.Layout.BASIC)
+
+def generate_infographic(data, as_bytes=False):
     try:
-        # Load fonts
-        georgia = ImageFont.truetype(FONT_PATHS['georgia'], 18)
-        georgia_bold = ImageFont.truetype(FONT_PATHS['georgia_bold'], 20)
-        footer_font = ImageFont.truetype(FONT_PATHS['georgia'], 16)
+        # Load fonts (parsed once per process)
+        georgia = _font(FONT_PATHS['georgia'], 18)
+        georgia_bold = _font(FONT_PATHS['georgia_bold'], 20)
+        footer_font = _font(FONT_PATHS['georgia'], 16)
 
         # Only Crypto metrics mapping
         crypto_map = {
@@ -49,8 +61,7 @@ def generate_infographic(data):
 
         # Table headers
         y_position = 60
-        x_position = 25
-        for col_name, col_width in REPORT_COLUMNS:
+        for (col_name, col_width), x_position in zip(REPORT_COLUMNS, COL_X):
             draw.rectangle(
                 [(x_position, y_position), (x_position + col_width, y_position + 30)],
                 fill=THEME['header']
@@ -62,43 +73,35 @@ def generate_infographic(data):
                 font=georgia_bold,
                 fill="white"
             )
-            x_position += col_width
 
         # Data rows for crypto
-        y_position = 90
         for idx, (metric_name, values) in enumerate(metrics):
-            x_position = 25
-            bg_color = "#F5F5F5" if idx % 2 == 0 else THEME['background']
-            draw.rectangle(
-                [(25, y_position), (520 - 25, y_position + row_height)],
-                fill=bg_color
-            )
+            y_position = header_height + idx * row_height
+            # Odd rows already show the canvas background, so only shade even rows.
+            # Non-last shaded rows stop 1px short so the following row's top edge
+            # stays background-coloured
+            if idx % 2 == 0:
+                bottom = y_position + row_height - (1 if idx < len(metrics) - 1 else 0)
+                draw.rectangle([(25, y_position), (520 - 25, bottom)], fill="#F5F5F5")
             # Metric name
-            draw.text((x_position + 5, y_position + 5), metric_name, font=georgia, fill=THEME['text'])
-            x_position += REPORT_COLUMNS[0][1]
+            draw.text((COL_X[0] + 5, y_position + 5), metric_name, font=georgia, fill=THEME['text'])
 
             # Today's value
-            today_val = values.get("Today")
+            today_val = values.today
             today_text = f"{today_val:,.0f}" if today_val and today_val > 1000 else f"{today_val:,.2f}"
-            draw.text((x_position + 5, y_position + 5), today_text, font=georgia, fill=THEME['text'])
-            x_position += REPORT_COLUMNS[1][1]
+            draw.text((COL_X[1] + 5, y_position + 5), today_text, font=georgia, fill=THEME['text'])
 
             # Percentage columns: Change, Monthly, YTD
-            for i, period in enumerate(["Change", "Monthly", "YTD"], start=2):
-                value = values.get(period)
-                color = THEME['positive'] if value is not None and value >= 0 else THEME['negative']
-                text = f"{value:+.1f}%" if value is not None else ""
-                col_width = REPORT_COLUMNS[i][1]
+            for i, value in enumerate((values.change, values.monthly, values.ytd), start=2):
+                color = THEME['positive'] if value >= 0 else THEME['negative']
+                text = f"{value:+.1f}%"
                 text_width = georgia.getlength(text)
                 draw.text(
-                    (x_position + (col_width - text_width) // 2, y_position + 5),
+                    (COL_X[i] + (COL_WIDTHS[i] - text_width) // 2, y_position + 5),
                     text,
                     font=georgia,
                     fill=color
                 )
-                x_position += col_width
-
-            y_position += row_height
 
         # Footer
         footer_text = "Data: CoinGecko"
@@ -110,9 +113,13 @@ def generate_infographic(data):
             fill="#666666"
         )
 
-        # Save image
+        # Save image (or hand back PNG bytes when the caller doesn't need a file)
+        if as_bytes:
+            buffer = io.BytesIO()
+            img.save(buffer, format="PNG", optimize=True)
+            return buffer.getvalue()
         filename = f"Crypto_Report_{datetime.now().strftime('%Y%m%d_%H%M')}.png"
-        img.save(filename)
+        img.save(filename, optimize=True)
         return filename
 
     except Exception as e: